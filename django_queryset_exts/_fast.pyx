@@ -0,0 +1,39 @@
+# cython: language_level=3
+"""Compiled version of the select_one_level grouping loop.
+
+Optional: query.py falls back to the pure-Python loop when this module
+has not been built (Cython is not a hard dependency).
+"""
+
+
+cpdef list _group_and_assign(list instances, list rel_objs, object instance_attr, object rel_obj_attr):
+    """Group rel_objs by rel_obj_attr and look each instance's value up.
+
+    Returns a list of (instance, value) tuples mirroring the pure-Python
+    loop in query.select_one_level.
+    """
+    cdef dict cache = {}
+    cdef list bucket
+    cdef list vals
+    cdef list out = []
+
+    for rel_obj in rel_objs:
+        key = rel_obj_attr(rel_obj)
+        if key in cache:
+            (<list>cache[key]).append(rel_obj)
+        else:
+            cache[key] = [rel_obj]
+
+    for obj in instances:
+        key = instance_attr(obj)
+        if isinstance(key, list):
+            vals = []
+            for one in <list>key:
+                bucket = <list>cache.get(one)
+                if bucket is not None and bucket:
+                    vals.append(bucket[0])
+            out.append((obj, vals))
+        else:
+            bucket = <list>cache.get(key)
+            out.append((obj, bucket[0] if bucket is not None and bucket else None))
+    return out
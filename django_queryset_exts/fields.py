@@ -1,46 +1,106 @@
+import asyncio
+import functools
 import json
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 
 import django
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.db import models
 from django.db.models import NOT_PROVIDED
 from django.db.models.query_utils import DeferredAttribute
 from django.utils.functional import curry
 
+try:
+    import orjson
+except ImportError:
+    _json_loads = json.loads
+    _json_dumps = json.dumps
+else:
+    _json_loads = orjson.loads
+
+    def _json_dumps(value):
+        # orjson emits raw UTF-8 rather than ASCII-escaped output
+        return orjson.dumps(value).decode('utf-8')
+
+# sentinel distinguishing "not cached yet" from a cached None
+_MISSING = object()
+
+if hasattr(asyncio, 'get_running_loop'):
+    _get_running_loop = asyncio.get_running_loop
+else:  # Python 3.6
+    _get_running_loop = asyncio.get_event_loop
+
+# 256-entry table flagging the ASCII hex digits, so validating a canonical
+# UUID is pure byte indexing with no uuid.UUID allocation or regex match.
+_HEX_OK = bytearray(256)
+for _c in b'0123456789abcdefABCDEF':
+    _HEX_OK[_c] = 1
+_HEX_OK = bytes(_HEX_OK)
+_UUID_HYPHEN_POSITIONS = (8, 13, 18, 23)
+
+
+def _is_canonical_uuid(value):
+    """True if value is a canonical 8-4-4-4-12 hex UUID string."""
+    try:
+        encoded = value.encode('ascii')
+    except (AttributeError, UnicodeEncodeError):
+        return False
+    if len(encoded) != 36:
+        return False
+    if not (encoded[8] == encoded[13] == encoded[18] == encoded[23] == 0x2d):
+        return False
+    hex_ok = _HEX_OK
+    hyphens = _UUID_HYPHEN_POSITIONS
+    for i, c in enumerate(encoded):
+        if not hex_ok[c] and i not in hyphens:
+            return False
+    return True
+
 
 class APIUUIDDescriptor(DeferredAttribute):
 
-    def __init__(self, field_name, model, single_method=None, batch_method=None, remote_uuid_getter=None, local_uuid_getter=None):
+    def __init__(self, field_name, model, single_method=None, batch_method=None, remote_uuid_getter=None, local_uuid_getter=None, max_workers=32, api_cache_maxsize=None):
         if django.VERSION < (2, 0):
             super().__init__(field_name, None)
         else:
             super().__init__(field_name)
         self.single_method = single_method
         self.batch_method = batch_method
+        self.max_workers = max_workers
+        # When api_cache_maxsize is set, results are reused across
+        # get_related_api_objects calls (the set() above only dedupes within
+        # one call), so overlapping querysets hit the remote only for uuids
+        # not seen before. Stale data is the trade-off; see invalidate().
+        self.api_cache_maxsize = api_cache_maxsize
+        if api_cache_maxsize and single_method is not None:
+            self.single_method = functools.lru_cache(maxsize=api_cache_maxsize)(single_method)
+        self._batch_cache = {} if api_cache_maxsize else None
         self.remote_uuid_getter = (remote_uuid_getter or (lambda d: d.get('uuid')))
         self.local_uuid_getter = (local_uuid_getter or (lambda d: d.get('uuid')))
-
-    @property
-    def cache_name(self):
-        return self.field_name
+        # The cached value lives directly in instance.__dict__ under this
+        # key, so every cache op is a single dict access instead of going
+        # through an intermediate per-instance dict.
+        self.cache_name = '_api_cache_' + self.field_name
+        # 'list' or 'scalar', learned lazily from the first non-empty value;
+        # the field is homogeneous so one check covers all instances.
+        self._kind = None
 
     def set_cache(self, instance, val):
-        if not hasattr(instance, '_api_related_cache'):
-            setattr(instance, '_api_related_cache', {})
-        getattr(instance, '_api_related_cache')[self.cache_name] = val
+        instance.__dict__[self.cache_name] = val
 
     def is_cached(self, instance):
-        return self.cache_name in getattr(instance, '_api_related_cache', {}).keys()
+        return self.cache_name in instance.__dict__
 
     def get_cache_value(self, instance):
-        return getattr(instance, '_api_related_cache', {}).get(self.cache_name)
+        return instance.__dict__.get(self.cache_name, _MISSING)
 
     def get_value(self, instance):
-        if self.is_cached(instance):
-            return self.get_cache_value(instance)
-        rel_qs, rel_obj_attr, _ = self.get_related_api_objects([instance])
-        for obj in rel_qs:
-            rel_obj_attr(obj)
+        value = instance.__dict__.get(self.cache_name, _MISSING)
+        if value is not _MISSING:
+            return value
+        rel_qs, _, _ = self.get_related_api_objects([instance])
         if isinstance(self.get_local_attr_value(instance), list):
             value = rel_qs
         else:
@@ -48,6 +108,18 @@ class APIUUIDDescriptor(DeferredAttribute):
         self.set_cache(instance, value)
         return value
 
+    async def aget_value(self, instance):
+        """
+        Async counterpart of get_value for use in async views: the cache is
+        checked synchronously, and only an actual remote fetch is pushed to a
+        thread so the event loop is not blocked on the API call.
+        """
+        value = instance.__dict__.get(self.cache_name, _MISSING)
+        if value is not _MISSING:
+            return value
+        loop = _get_running_loop()
+        return await loop.run_in_executor(None, self.get_value, instance)
+
     def get_local_attr_value(self, instance):
         value = getattr(instance, self.field_name)
         # value supports those formats:
@@ -67,31 +139,58 @@ class APIUUIDDescriptor(DeferredAttribute):
         else:
             return value
 
-    @property
-    def temp_identifier_name(self):
-        return '_' + self.field_name + '_identifier'
-
     def get_related_api_objects(self, instances):
-        uuids = set()
-        for instance in instances:
-            value = self.get_local_attr_value(instance)
-            if isinstance(value, list):
-                uuids.update(value)
-            else:
-                uuids.add(value)
+        get_local_attr_value = self.get_local_attr_value
+        kind = self._kind
+        if kind is None:
+            for instance in instances:
+                value = get_local_attr_value(instance)
+                if value:
+                    kind = self._kind = 'list' if isinstance(value, list) else 'scalar'
+                    break
+        if kind == 'list':
+            uuids = set(chain.from_iterable(
+                value for value in (get_local_attr_value(instance) for instance in instances) if value))
+        elif kind == 'scalar':
+            uuids = {get_local_attr_value(instance) for instance in instances}
+            uuids.discard(None)
+        else:
+            uuids = set()  # every instance is empty, nothing to fetch
         uuids = list(uuids)
 
         if self.batch_method:
-            data = self.batch_method(uuids)
-            for d in data:
-                d[self.temp_identifier_name] = self.remote_uuid_getter(d)  # TODO: refactor
+            batch_cache = self._batch_cache
+            if batch_cache is None:
+                data = self.batch_method(uuids)
+            else:
+                # evict before computing missing, so anything dropped here is
+                # refetched below instead of silently vanishing from data
+                if len(batch_cache) >= self.api_cache_maxsize:
+                    batch_cache.clear()  # crude bound, good enough for a dedupe cache
+                missing = [uuid for uuid in uuids if uuid not in batch_cache]
+                if missing:
+                    for d in self.batch_method(missing):
+                        batch_cache[self.remote_uuid_getter(d)] = d
+                data = [batch_cache[uuid] for uuid in uuids if uuid in batch_cache]
         else:
-            data = []
-            for uuid in uuids:
-                d = self.single_method(uuid)
-                d[self.temp_identifier_name] = uuid
-                data.append(d)
-        return data, lambda x: x.pop(self.temp_identifier_name, None), self.get_local_attr_value
+            # single_method calls are I/O bound (remote API), so dispatch them
+            # concurrently instead of paying the latency once per uuid.
+            if len(uuids) > 1:
+                with ThreadPoolExecutor(max_workers=min(self.max_workers, len(uuids))) as executor:
+                    data = list(executor.map(self.single_method, uuids))
+            else:
+                data = [self.single_method(uuid) for uuid in uuids]
+        # remote_uuid_getter reads the identifier straight off each dict, so
+        # there is no need to stamp (and later pop) a temporary key.
+        return data, self.remote_uuid_getter, self.get_local_attr_value
+
+    def invalidate(self):
+        """Drop all cached API results (only relevant with api_cache_maxsize)."""
+        if self._batch_cache:
+            self._batch_cache.clear()
+        cache_clear = getattr(self.single_method, 'cache_clear', None)
+        if cache_clear is not None:
+            cache_clear()
 
 
 class APIUUIDDataDescriptor:
@@ -99,27 +198,38 @@ class APIUUIDDataDescriptor:
     def __init__(self, field_name, model, cls_descriptor: APIUUIDDescriptor):
         self.field_name = field_name
         self.cls_descriptor = cls_descriptor  # type: APIUUIDDescriptor
+        self.attname_data = field_name + '_data'
 
     def __get__(self, instance, owner):
         if not instance:
             return self
         value = self.cls_descriptor.get_value(instance)
+        # This is a non-data descriptor (no __set__), so once the value is
+        # in instance.__dict__ later reads skip the descriptor protocol
+        # entirely.
+        instance.__dict__[self.attname_data] = value
         return value
 
-    def __set__(self, instance, value):
-        if not instance:
-            pass
-        self.cls_descriptor.set_cache(instance, value)
+    async def aget(self, instance):
+        """
+        Await the value from an async view, where a blocking __get__ would
+        stall the event loop: ``await MyModel.remote_uuid_data.aget(obj)``.
+        """
+        value = await self.cls_descriptor.aget_value(instance)
+        instance.__dict__[self.attname_data] = value
+        return value
 
 
 class RemoteUUIDFieldMixin:
-    def __init__(self, *args, single_method=None, batch_method=None, local_uuid_getter=None, remote_uuid_getter=None, **kwargs):
+    def __init__(self, *args, single_method=None, batch_method=None, local_uuid_getter=None, remote_uuid_getter=None, max_workers=32, api_cache_maxsize=None, **kwargs):
 
         # TODO: do validate here
         self.single_method = single_method
         self.batch_method = batch_method
         self.local_uuid_getter = local_uuid_getter
         self.remote_uuid_getter = remote_uuid_getter
+        self.max_workers = max_workers
+        self.api_cache_maxsize = api_cache_maxsize
         super().__init__(*args, **kwargs)
 
     def deconstruct(self):
@@ -128,6 +238,8 @@ class RemoteUUIDFieldMixin:
         kwargs['batch_method'] = self.batch_method
         kwargs['local_uuid_getter'] = self.local_uuid_getter
         kwargs['remote_uuid_getter'] = self.remote_uuid_getter
+        kwargs['max_workers'] = self.max_workers
+        kwargs['api_cache_maxsize'] = self.api_cache_maxsize
         return name, path, args, kwargs
 
     def contribute_to_class(self, cls, name, private_only=False, virtual_only=NOT_PROVIDED):
@@ -153,7 +265,8 @@ class RemoteUUIDFieldMixin:
             if not getattr(cls, self.attname, None):
                 cls_descriptor = APIUUIDDescriptor(self.attname, cls, single_method=self.single_method,
                                                    batch_method=self.batch_method,
-                                                   local_uuid_getter=self.local_uuid_getter, remote_uuid_getter=self.remote_uuid_getter)
+                                                   local_uuid_getter=self.local_uuid_getter, remote_uuid_getter=self.remote_uuid_getter,
+                                                   max_workers=self.max_workers, api_cache_maxsize=self.api_cache_maxsize)
                 setattr(cls, self.attname, cls_descriptor)
                 setattr(cls, '%s_data' % self.name,
                         APIUUIDDataDescriptor(self.attname, cls, cls_descriptor=cls_descriptor))
@@ -163,6 +276,12 @@ class RemoteUUIDFieldMixin:
 
 
 class ListFieldMixin:
+    # from_db_value runs once per row per queryset iteration, so both
+    # converters check exact types first (a pointer compare) and only fall
+    # back to isinstance for the rare str/list subclass.
+    _invalid_value_msg = 'Invalid value for {}\'s {}.'
+    _join = staticmethod(','.join)
+
     if django.VERSION < (2, 0):
         def from_db_value(self, value, expression, connection, context):
             return self.to_python(value)
@@ -173,28 +292,60 @@ class ListFieldMixin:
     def to_python(self, value):
         if not value:
             return []
+        t = type(value)
+        if t is str:
+            return value.split(',')
+        if t is list:
+            return value
         if isinstance(value, str):
-            if value:
-                return value.split(',')
-            return []
+            return value.split(',')
         if isinstance(value, list):
             return value
-        raise ValidationError('Invalid value for {}\'s {}.'.format(self.model.__name__, self.name))
+        raise ValidationError(self._invalid_value_msg.format(self.model.__name__, self.name))
 
     def get_prep_value(self, value):
         if value is None:
             return None
         if not value:
             return ''
+        t = type(value)
+        if t is str:
+            return value
+        if t is list:
+            if settings.DEBUG:
+                # coerce elements while developing so a stray non-str shows
+                # up in the stored value rather than as a TypeError
+                return self._join(map(str, value))
+            return self._join(value)
         if isinstance(value, str):
             return value
         if isinstance(value, list):
-            return ','.join(value)
-        raise ValidationError('Invalid value for {}\'s {}.'.format(self.model.__name__, self.name))
+            return self._join(value)
+        raise ValidationError(self._invalid_value_msg.format(self.model.__name__, self.name))
 
 
 class RemoteUUIDField(RemoteUUIDFieldMixin, models.CharField):
-    pass
+    # validate_uuid lives here and not on the mixin: the list fields define
+    # their own to_python without calling super(), so accepting the kwarg
+    # there would make it a silent no-op.
+
+    def __init__(self, *args, validate_uuid=False, **kwargs):
+        # opt-in: the remote identifier is not necessarily a real UUID, so
+        # format checking must be asked for explicitly
+        self.validate_uuid = validate_uuid
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs['validate_uuid'] = self.validate_uuid
+        return name, path, args, kwargs
+
+    def to_python(self, value):
+        value = super().to_python(value)
+        if self.validate_uuid and value and not _is_canonical_uuid(value):
+            raise ValidationError('{!r} is not a canonical UUID for {}\'s {}.'.format(
+                value, self.model.__name__, self.name))
+        return value
 
 
 class RemoteUUIDListField(ListFieldMixin, RemoteUUIDFieldMixin, models.CharField):
@@ -219,9 +370,10 @@ class RemoteUUIDListJSONField(RemoteUUIDFieldMixin, models.TextField):
         if isinstance(value, str):
             if value:
                 try:
-                    return json.loads(value)
-                except Exception as e:
-                    _ = e
+                    return _json_loads(value)
+                except ValueError:
+                    # malformed data in the column; orjson.JSONDecodeError
+                    # subclasses ValueError just like json's
                     return []
             return []
         if isinstance(value, list):
@@ -234,5 +386,5 @@ class RemoteUUIDListJSONField(RemoteUUIDFieldMixin, models.TextField):
         if isinstance(value, str):
             return value
         if isinstance(value, list):
-            return json.dumps(value)
+            return _json_dumps(value)
         raise ValidationError('Invalid value for {}\'s {}.'.format(self.model.__name__, self.name))
@@ -1,5 +1,5 @@
-import copy
-from collections import deque
+from collections import defaultdict, deque
+from functools import lru_cache
 
 from django.core import exceptions
 from django.db import models
@@ -7,7 +7,13 @@ from django.db.models.constants import LOOKUP_SEP
 from django.db.models.signals import post_save
 from django.utils.functional import cached_property
 
-from .signals import pre_update, post_update
+from .fields import _MISSING
+from .signals import pre_update, post_update, post_bulk_create
+
+try:
+    from ._fast import _group_and_assign
+except ImportError:
+    _group_and_assign = None
 
 
 class APIQueryset(models.QuerySet):
@@ -22,25 +28,37 @@ class APIQueryset(models.QuerySet):
         """
         Deep copy of a QuerySet doesn't populate the cache
         """
-        obj = self.__class__()
-        for k, v in self.__dict__.items():
-            if k in ['_result_cache', '_api_result_cache']:
-                obj.__dict__[k] = None
-            else:
-                obj.__dict__[k] = copy.deepcopy(v, memo)
+        obj = super().__deepcopy__(memo)
+        # The extension attributes need no deepcopy of their own: the fields
+        # tuple is immutable (SelectAPIRelated copies as itself) and the
+        # other two are cache state that must start empty on a copy anyway.
+        obj._select_related_api_fields = self._select_related_api_fields
+        obj._select_related_api_done = False
+        obj._api_result_cache = None
         return obj
 
     def update(self, **kwargs):
-        pre_update.send(sender=self.model, queryset=self._clone(), kwargs=kwargs)
+        # The signals get the live queryset rather than a _clone(): cloning
+        # copies the whole Query tree twice per update() just to hand
+        # receivers a read-only reference. Receivers that need an independent
+        # snapshot can call queryset.all() themselves.
+        pre_update.send(sender=self.model, queryset=self, kwargs=kwargs)
         result = super().update(**kwargs)
-        post_update.send(sender=self.model, queryset=self._clone(), kwargs=kwargs, result=result)
+        post_update.send(sender=self.model, queryset=self, kwargs=kwargs, result=result)
         return result
 
     def bulk_create(self, objs, batch_size=None):
         objs = super().bulk_create(objs, batch_size)
-        for obj in objs:
-            post_save.send(sender=self.model, instance=obj, created=getattr(self, 'pk', None),
-                           update_fields=None, raw=False, using=None,)
+        # One signal for the whole batch; dispatching post_save per object
+        # restores the O(N) overhead bulk_create exists to avoid. Models that
+        # still rely on per-object post_save receivers can opt back in with a
+        # class attribute.
+        post_bulk_create.send(sender=self.model, instances=objs)
+        if getattr(self.model, 'emit_post_save_on_bulk', False):
+            send = post_save.send
+            for obj in objs:
+                send(sender=self.model, instance=obj, created=getattr(self, 'pk', None),
+                     update_fields=None, raw=False, using=None,)
         return objs
 
     def select_api_related(self, *fields):
@@ -76,8 +94,14 @@ class SelectAPIRelated:
 
     def __init__(self, lookup, to_attr=None):
         self.select_through = lookup
+        self.through_attrs = lookup.split(LOOKUP_SEP)
         self.to_attr = '{}_{}'.format(lookup, 'data') if not to_attr else to_attr  # TODO: 优化
-        self.select_to = LOOKUP_SEP.join(lookup.split(LOOKUP_SEP)[:-1] + [self.to_attr])
+        self.select_to = LOOKUP_SEP.join(self.through_attrs[:-1] + [self.to_attr])
+        # The per-level views of select_to are asked for on every step of the
+        # BFS in select_related_api_objects, so split/join once here.
+        self._select_parts = self.select_to.split(LOOKUP_SEP)
+        self._prefix_at_level = [LOOKUP_SEP.join(self._select_parts[:i + 1])
+                                 for i in range(len(self._select_parts))]
 
     def __eq__(self, other):
         if isinstance(other, SelectAPIRelated):
@@ -87,13 +111,16 @@ class SelectAPIRelated:
     def __hash__(self):
         return hash(self.__class__) ^ hash(self.select_to)
 
+    def __deepcopy__(self, memo):
+        # effectively immutable once constructed, so a copy is never needed
+        return self
+
     def get_current_select_to(self, level):
-        return LOOKUP_SEP.join(self.select_to.split(LOOKUP_SEP)[:level + 1])
+        return self._prefix_at_level[level]
 
     def get_current_to_attr(self, level):
-        parts = self.select_to.split(LOOKUP_SEP)
-        to_attr = parts[level]
-        as_attr = self.to_attr and level == len(parts) - 1
+        to_attr = self._select_parts[level]
+        as_attr = self.to_attr and level == len(self._select_parts) - 1
         return to_attr, as_attr
 
 
@@ -117,36 +144,48 @@ def select_related_api_objects(model_instances, *related_lookups):
     # 全部用SelectAPIRelated对象包装
     related_lookups = normalize_api_select(related_lookups)
 
-    # Need some book keeping to ensure we don't do duplicate work.
-    done_queries = {}  # dictionary of things like 'foo__bar': [results]
+    # Need some book keeping to ensure we don't do duplicate work. The guard
+    # checks run on every BFS step, so they go against a slim set of prefix
+    # strings; the (potentially large) result lists live in a separate dict
+    # that is only consulted when a later lookup actually descends through a
+    # prefix that was already selected.
+    visited_prefixes = set()  # things like 'foo__bar'
+    prefix_to_objs = {}  # dictionary of things like 'foo__bar': [results]
 
     auto_lookups = set()  # we add to this as we go through.
-    followed_descriptors = set()  # recursion protection
+    # recursion protection; keyed by id() so the set holds plain ints instead
+    # of references that would pin the descriptors (they stay alive for the
+    # whole function, so the ids cannot be recycled underneath us)
+    followed_descriptor_ids = set()
 
     all_lookups = deque(related_lookups)
     while all_lookups:
         lookup = all_lookups.popleft()
-        if lookup.select_to in done_queries:
+        if lookup.select_to in visited_prefixes:
             continue
 
         # Top level, the list of objects to decorate is the result cache
         # from the primary QuerySet. It won't be for deeper levels.
         obj_list = model_instances
 
-        through_attrs = lookup.select_through.split(LOOKUP_SEP)
+        # hoist per-lookup attribute lookups out of the level loop
+        get_select_to = lookup.get_current_select_to
+        get_to_attr = lookup.get_current_to_attr
+        through_attrs = lookup.through_attrs
+        last_level = len(through_attrs) - 1
         for level, through_attr in enumerate(through_attrs):
             # Prepare main instances
             if len(obj_list) == 0:
                 break
 
-            select_to = lookup.get_current_select_to(level)
-            if select_to in done_queries:
-                obj_list = done_queries[select_to]
+            select_to = get_select_to(level)
+            if select_to in visited_prefixes:
+                obj_list = prefix_to_objs[select_to]
                 continue
 
             # Descend down tree
             first_obj = obj_list[0]
-            to_attr = lookup.get_current_to_attr(level)[0]  # 用来判断 is_fetched
+            to_attr = get_to_attr(level)[0]  # 用来判断 is_fetched
             something_for_select, descriptor, attr_found, is_fetched \
                 = get_something_can_do_select_api(first_obj, through_attr, to_attr)
 
@@ -155,7 +194,7 @@ def select_related_api_objects(model_instances, *related_lookups):
                                      "parameter to select_api_related()" %
                                      (through_attr, first_obj.__class__.__name__, lookup.select_through))
 
-            if level == len(through_attrs) - 1 and something_for_select is None:
+            if level == last_level and something_for_select is None:
                 # Last one, this *must* resolve to something that supports
                 # api_select, otherwise there is no point adding it and the
                 # developer asking for it has made a mistake.
@@ -165,9 +204,10 @@ def select_related_api_objects(model_instances, *related_lookups):
 
             if something_for_select is not None and not is_fetched:
                 obj_list = select_one_level(obj_list, something_for_select, lookup, level)
-                if descriptor not in followed_descriptors:
-                    done_queries[select_to] = obj_list
-                followed_descriptors.add(descriptor)
+                if id(descriptor) not in followed_descriptor_ids:
+                    visited_prefixes.add(select_to)
+                    prefix_to_objs[select_to] = obj_list
+                followed_descriptor_ids.add(id(descriptor))
             else:
                 new_obj_list = []
                 for obj in obj_list:
@@ -175,10 +215,17 @@ def select_related_api_objects(model_instances, *related_lookups):
                     if something_for_select:
                         this_descriptor = something_for_select
                         new_obj = this_descriptor.get_cache_value(obj)
+                        if new_obj is _MISSING:
+                            new_obj = None
                     elif through_attr in getattr(obj, '_prefetched_objects_cache', ()):
                         # If related objects have been prefetched, use the
-                        # cache rather than the object's through_attr.
-                        new_obj = list(obj._prefetched_objects_cache.get(through_attr))
+                        # cache rather than the object's through_attr. Django
+                        # stores the prefetched objects as a queryset whose
+                        # _result_cache is already a list; reuse it (we only
+                        # read it below) instead of copying per parent row.
+                        prefetched = obj._prefetched_objects_cache[through_attr]
+                        result_cache = getattr(prefetched, '_result_cache', None)
+                        new_obj = result_cache if result_cache is not None else list(prefetched)
                     else:
                         try:
                             new_obj = getattr(obj, through_attr)
@@ -198,30 +245,44 @@ def select_related_api_objects(model_instances, *related_lookups):
                 obj_list = new_obj_list
 
 
-def get_something_can_do_select_api(instance, through_attr, to_attr):
-    something = None
-    is_fetched = False
-
+@lru_cache(maxsize=1024)
+def _resolve_class_descriptor(cls, through_attr, to_attr):
+    """
+    Class-level half of get_something_can_do_select_api: which descriptor
+    handles through_attr and how is_fetched must be checked. The answer only
+    depends on the model class, so it is memoized across querysets (the
+    bounded cache keeps replaced model classes from piling up).
+    """
     # For singly related objects, we have to avoid getting the attribute
     # from the object, as this will trigger the query. So we first try
     # on the class, in order to get the descriptor object.
-    rel_obj_descriptor = getattr(instance.__class__, through_attr, None)
+    something = None
+    fetched_via_dict = False
+    rel_obj_descriptor = getattr(cls, through_attr, None)
+    if rel_obj_descriptor:
+        if hasattr(rel_obj_descriptor, 'get_related_api_objects'):
+            if through_attr == to_attr:
+                raise ValueError('through_attr must not equal to to_attr')
+            something = rel_obj_descriptor
+            # Special case cached_property instances because hasattr
+            # triggers attribute computation and assignment.
+            fetched_via_dict = isinstance(getattr(cls, to_attr, None), cached_property)
+    return something, rel_obj_descriptor, fetched_via_dict
+
+
+def get_something_can_do_select_api(instance, through_attr, to_attr):
+    something, rel_obj_descriptor, fetched_via_dict = \
+        _resolve_class_descriptor(instance.__class__, through_attr, to_attr)
     if rel_obj_descriptor is None:
         attr_found = hasattr(instance, through_attr)
     else:
         attr_found = True
-        if rel_obj_descriptor:
-            if hasattr(rel_obj_descriptor, 'get_related_api_objects'):
-                something = rel_obj_descriptor
-                if through_attr != to_attr:
-                    # Special case cached_property instances because hasattr
-                    # triggers attribute computation and assignment.
-                    if isinstance(getattr(instance.__class__, to_attr, None), cached_property):
-                        is_fetched = to_attr in instance.__dict__
-                    else:
-                        is_fetched = rel_obj_descriptor.is_cached(instance)
-                else:
-                    raise ValueError('through_attr must not equal to to_attr')
+    is_fetched = False
+    if something is not None:
+        if fetched_via_dict:
+            is_fetched = to_attr in instance.__dict__
+        else:
+            is_fetched = something.is_cached(instance)
     return something, rel_obj_descriptor, attr_found, is_fetched
 
 
@@ -231,11 +292,6 @@ def select_one_level(instances, something_for_select, lookup, level):
 
     all_related_objects = list(rel_qs)
 
-    rel_obj_cache = {}
-    for rel_obj in all_related_objects:
-        rel_attr_val = rel_obj_attr(rel_obj)
-        rel_obj_cache.setdefault(rel_attr_val, []).append(rel_obj)
-
     to_attr, as_attr = lookup.get_current_to_attr(level)
     # Make sure `to_attr` does not conflict with a field.
     if as_attr and instances:
@@ -250,18 +306,36 @@ def select_one_level(instances, something_for_select, lookup, level):
             msg = 'select_api_related to_attr={} conflicts with a field on the {} model.'
             raise ValueError(msg.format(to_attr, model.__name__))
 
-    for obj in instances:
-        instance_attr_val = instance_attr(obj)
+    set_cache = something_for_select.set_cache
+
+    if _group_and_assign is not None:
+        # compiled grouping + lookup loop (built from _fast.pyx when Cython
+        # is available); semantics match the pure-Python loop below
+        for obj, val in _group_and_assign(instances, all_related_objects, instance_attr, rel_obj_attr):
+            set_cache(obj, val)
+            setattr(obj, to_attr, val)
+        return all_related_objects
+
+    rel_obj_cache = defaultdict(list)
+    for rel_obj in all_related_objects:
+        rel_obj_cache[rel_obj_attr(rel_obj)].append(rel_obj)
+
+    # Extract every instance's key up front so the assignment loop below is
+    # pure dict lookups.
+    instance_attr_vals = [instance_attr(obj) for obj in instances]
+
+    rel_obj_cache_get = rel_obj_cache.get
+    for obj, instance_attr_val in zip(instances, instance_attr_vals):
         if isinstance(instance_attr_val, list):
             val = []
             for instance_attr_val_one in instance_attr_val:
-                val_one = rel_obj_cache.get(instance_attr_val_one, [])
+                val_one = rel_obj_cache_get(instance_attr_val_one, [])
                 if val_one:
                     val.append(val_one[0])
         else:
-            vals = rel_obj_cache.get(instance_attr_val, [])
+            vals = rel_obj_cache_get(instance_attr_val, [])
 
             val = vals[0] if vals else None
-        something_for_select.set_cache(obj, val)
+        set_cache(obj, val)
         setattr(obj, to_attr, val)
     return all_related_objects
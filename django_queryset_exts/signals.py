@@ -2,3 +2,4 @@ from django.dispatch import Signal
 
 pre_update = Signal(providing_args=["queryset", "kwargs"])
 post_update = Signal(providing_args=["queryset", "kwargs", "result"])
+post_bulk_create = Signal(providing_args=["instances"])
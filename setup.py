@@ -1,4 +1,37 @@
+import os
+
 import setuptools
+from setuptools.command.build_ext import build_ext
+
+# The _fast extension is a pure accelerator: the library runs fine on its
+# pure-Python fallbacks, so neither a missing .pyx, a missing Cython, nor a
+# failing C compiler should break installation.
+ext_modules = []
+_pyx_path = os.path.join('django_queryset_exts', '_fast.pyx')
+if os.path.exists(_pyx_path):
+    try:
+        from Cython.Build import cythonize
+    except ImportError:
+        pass
+    else:
+        ext_modules = cythonize([_pyx_path])
+
+
+class OptionalBuildExt(build_ext):
+    """Skip the accelerator instead of failing when it cannot be compiled."""
+
+    def run(self):
+        try:
+            build_ext.run(self)
+        except Exception as e:
+            print('Skipping optional extension build: {}'.format(e))
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except Exception as e:
+            print('Skipping optional extension {}: {}'.format(ext.name, e))
+
 
 with open("README.md", "r") as fh:
     long_description = fh.read()
@@ -13,6 +46,8 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/zzhhss/django-queryset-exts",
     packages=setuptools.find_packages(),
+    ext_modules=ext_modules,
+    cmdclass={'build_ext': OptionalBuildExt},
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",